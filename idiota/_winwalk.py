@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batched directory listing for Windows
+
+FindFirstFileExW returns the name and attributes of every entry in the
+directory listing itself, so no extra call per file is needed to find out
+whether it is a file, a directory or a reparse point.
+"""
+__author__ = "prakashsellathurai"
+__copyright__ = "Copyright 2021"
+__version__ = "1.0.1"
+__email__ = "prakashsellathurai@gmail.com"
+
+import ctypes
+from ctypes import wintypes
+
+
+FILE_ATTRIBUTE_DIRECTORY = 0x10
+FILE_ATTRIBUTE_REPARSE_POINT = 0x400
+
+FindExInfoBasic = 1
+FindExSearchNameMatch = 0
+FIND_FIRST_EX_LARGE_FETCH = 2
+
+ERROR_FILE_NOT_FOUND = 2
+ERROR_NO_MORE_FILES = 18
+INVALID_HANDLE_VALUE = wintypes.HANDLE(-1).value
+
+
+class WIN32_FIND_DATAW(ctypes.Structure):
+    _fields_ = [
+        ('dwFileAttributes', wintypes.DWORD),
+        ('ftCreationTime', wintypes.FILETIME),
+        ('ftLastAccessTime', wintypes.FILETIME),
+        ('ftLastWriteTime', wintypes.FILETIME),
+        ('nFileSizeHigh', wintypes.DWORD),
+        ('nFileSizeLow', wintypes.DWORD),
+        ('dwReserved0', wintypes.DWORD),
+        ('dwReserved1', wintypes.DWORD),
+        ('cFileName', wintypes.WCHAR * 260),
+        ('cAlternateFileName', wintypes.WCHAR * 14),
+    ]
+
+
+kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+
+kernel32.FindFirstFileExW.argtypes = [
+    wintypes.LPCWSTR, ctypes.c_int, ctypes.c_void_p,
+    ctypes.c_int, ctypes.c_void_p, wintypes.DWORD]
+kernel32.FindFirstFileExW.restype = wintypes.HANDLE
+kernel32.FindNextFileW.argtypes = [
+    wintypes.HANDLE, ctypes.POINTER(WIN32_FIND_DATAW)]
+kernel32.FindNextFileW.restype = wintypes.BOOL
+kernel32.FindClose.argtypes = [wintypes.HANDLE]
+kernel32.FindClose.restype = wintypes.BOOL
+
+
+def scandir_batch(path):
+    """
+    List a directory with FindFirstFileExW / FindNextFileW
+
+    Args:
+        path (str): directory to list
+
+    Yields:
+        WIN32_FIND_DATAW: one record per entry, excluding '.' and '..'
+    """
+    buf = WIN32_FIND_DATAW()
+    handle = kernel32.FindFirstFileExW(
+        path + '\\*', FindExInfoBasic, ctypes.byref(buf),
+        FindExSearchNameMatch, None, FIND_FIRST_EX_LARGE_FETCH)
+    if handle == INVALID_HANDLE_VALUE:
+        error = ctypes.get_last_error()
+        if error == ERROR_FILE_NOT_FOUND:
+            return
+        raise ctypes.WinError(error)
+
+    try:
+        while True:
+            if buf.cFileName not in ('.', '..'):
+                yield WIN32_FIND_DATAW.from_buffer_copy(buf)
+            if not kernel32.FindNextFileW(handle, ctypes.byref(buf)):
+                error = ctypes.get_last_error()
+                if error == ERROR_NO_MORE_FILES:
+                    return
+                raise ctypes.WinError(error)
+    finally:
+        kernel32.FindClose(handle)
@@ -9,15 +9,32 @@ __copyright__ = "Copyright 2021"
 __version__ = "1.0.1"
 __email__ = "prakashsellathurai@gmail.com"
 
-import itertools
-import operator
+import functools
 import os
+import re
 import string
+import sys
+import time
 from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from . import data
 from . import diff
 
+if sys.platform == 'win32':
+    from . import _winwalk
+
+_HEX = frozenset(string.hexdigits)
+
+# Reading and hashing files releases the GIL, so threads overlap both
+_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Directories with fewer files are added as loose objects
+_PACK_MIN_FILES = 64
+
+# 100ns intervals between the FILETIME epoch (1601) and the Unix epoch
+_FILETIME_EPOCH = 116444736000000000
+
 
 def init():
     """
@@ -32,37 +49,44 @@ def write_tree():
     """
     Write the current working tree to the index
     """
-    # Index is flat, we need it as a tree of dicts
-    index_as_tree = {}
+    # Index is flat, group its blobs by directory in a single pass
+    tree = {'': []}
     with data.get_index() as index:
         for path, oid in index.items():
-            path = path.split('/')
-            dirpath, filename = path[:-1], path[-1]
-
-            current = index_as_tree
-            # Find the dict for the directory of this file
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict):
-        # Write the tree to the object store
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive(value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append((name, oid, type_))
+            dirpath, _, filename = path.rpartition('/')
+            entries = tree.get(dirpath)
+            if entries is None:
+                entries = tree[dirpath] = []
+                # Register any missing ancestors once
+                parent = dirpath.rpartition('/')[0]
+                while parent not in tree:
+                    tree[parent] = []
+                    parent = parent.rpartition('/')[0]
+            entries.append((filename, oid, 'blob'))
+
+    # Write the trees to the object store bottom-up: the deepest directories
+    # first, so every subtree oid is known before its parent is written
+    def depth(dirpath):
+        return dirpath.count('/') + bool(dirpath)
+
+    # Identical subtrees hash to the same oid, serialize and write them once
+    written = {}
+    for dirpath in sorted(tree, key=depth, reverse=True):
+        entries = tuple(sorted(tree[dirpath]))
+        oid = written.get(entries)
+        if oid is None:
+            tree_object = ''.join(f'{type_} {entry_oid} {entry_name}\n'
+                                  for entry_name, entry_oid, type_
+                                  in entries)
+            oid = written[entries] = data.hash_object(
+                tree_object.encode(), 'tree')
+        if dirpath:
+            parent, _, name = dirpath.rpartition('/')
+            tree[parent].append((name, oid, 'tree'))
+    return oid
 
-        tree = ''.join(f'{type_} {oid} {name}\n'
-                       for name, oid, type_
-                       in sorted(entries))
-        return data.hash_object(tree.encode(), 'tree')
 
-    return write_tree_recursive(index_as_tree)
+_TREE_ENTRY_RE = re.compile(rb'([a-z]+) ([0-9a-f]{40}) ([^\n]+)\n')
 
 
 def _iter_tree_entries(oid):
@@ -77,9 +101,14 @@ def _iter_tree_entries(oid):
     if not oid:
         return
     tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(' ', 2)
-        yield type_, oid, name
+    # Entries must follow each other back to back, a gap is a corrupt line
+    end = 0
+    for match in _TREE_ENTRY_RE.finditer(tree):
+        assert match.start() == end, f'Corrupt tree {oid}'
+        end = match.end()
+        type_, entry_oid, name = match.groups()
+        yield type_.decode('ascii'), entry_oid.decode('ascii'), name.decode()
+    assert end == len(tree), f'Corrupt tree {oid}'
 
 
 def get_tree(oid, base_path=''):
@@ -94,20 +123,98 @@ def get_tree(oid, base_path=''):
     returns:
         A dictionary of path -> oid
     """
+    tree = _get_tree_raw(oid)
+    if not base_path:
+        return dict(tree)
+    return {base_path + path: oid for path, oid in tree.items()}
+
+
+@functools.lru_cache(maxsize=256)
+def _get_tree_raw(oid):
+    """
+    Flatten a tree into a dictionary of relative path -> blob oid
+
+    Trees are immutable under their oid, so every subtree's flattened result
+    is memoized and a parent is built from its children's cached dicts:
+    subtrees shared between commits are only parsed once. Each entry holds
+    a whole flattened subtree, hence the small bound. Callers must not
+    mutate the result.
+    """
+    # Entries come in sorted order and a subtree is spliced in where it
+    # appears, the same pre-order a plain recursive walk gives
     result = {}
     for type_, oid, name in _iter_tree_entries(oid):
         assert '/' not in name
         assert name not in ('..', '.')
-        path = base_path + name
         if type_ == 'blob':
-            result[path] = oid
+            result[name] = oid
         elif type_ == 'tree':
-            result.update(get_tree(oid, f'{path}/'))
+            base_path = f'{name}/'
+            for path, blob_oid in _get_tree_raw(oid).items():
+                result[base_path + path] = blob_oid
         else:
             assert False, f'Unknown tree entry {type_}'
     return result
 
 
+def _walk_files(root):
+    """
+    Walk the files under root using os.scandir
+
+    The .idiota directory is pruned before it is descended into, so nothing
+    below it is ever yielded, and the file type checks use the stat data
+    cached on each DirEntry.
+
+    Args:
+        root (str): The directory to walk
+    Yields:
+        Tuple of (path, DirEntry) for every regular file
+    """
+    if is_ignored(os.path.relpath(root).replace(os.sep, '/')):
+        return
+
+    if sys.platform == 'win32':
+        yield from _walk_files_win32(root)
+        return
+
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != '.idiota':
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry
+
+
+def _walk_files_win32(root):
+    """
+    Walk the files under root using batched FindFirstFileExW listings
+
+    Reparse points (symlinks, junctions) are skipped, matching the
+    follow_symlinks=False checks of the os.scandir walk.
+
+    Args:
+        root (str): The directory to walk
+    Yields:
+        Tuple of (path, WIN32_FIND_DATAW) for every regular file
+    """
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        for record in _winwalk.scandir_batch(dirpath):
+            attributes = record.dwFileAttributes
+            if attributes & _winwalk.FILE_ATTRIBUTE_REPARSE_POINT:
+                continue
+            path = f'{dirpath}/{record.cFileName}'
+            if attributes & _winwalk.FILE_ATTRIBUTE_DIRECTORY:
+                if record.cFileName != '.idiota':
+                    stack.append(path)
+            else:
+                yield path, record
+
+
 def get_working_tree():
     """
     Get the current working tree as a dictionary of path -> oid
@@ -115,20 +222,75 @@ def get_working_tree():
     args:
         None
 
+    Files whose mtime, size and inode match the stat cache are not re-hashed.
+
     Returns:
         A dictionary of path -> oids
     """
+    start = time.time_ns()
+    cached = data.get_stat_cache()
+    stat_cache = {}
     result = {}
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
+    stale = []
+    for path, entry in _walk_files('.'):
+        # Already relative, only the leading './' of the walk root goes
+        path = path[2:]
+        key = _stat_key(entry)
+        entry = cached.get(path)
+        if entry is not None and entry[1:] == key:
+            result[path] = entry[0]
+            stat_cache[path] = entry
+        else:
+            stale.append((path, key))
+
+    hashed = _hash_files([path for path, _ in stale])
+    for path, key in stale:
+        oid = result[path] = hashed[path]
+        # A file modified in the same second as this scan can change again
+        # without its mtime moving, so only trust it on a later scan
+        if key[0] // 10**9 < start // 10**9:
+            stat_cache[path] = (oid, *key)
+
+    if stat_cache != cached:
+        data.set_stat_cache(stat_cache)
     return result
 
 
+def _stat_key(entry):
+    """
+    Build the stat cache key of a file from its walk entry
+
+    args:
+        entry: The DirEntry or WIN32_FIND_DATAW yielded by _walk_files
+
+    returns:
+        Tuple of (mtime_ns, size, inode)
+    """
+    if sys.platform == 'win32':
+        # FILETIME counts 100ns intervals since 1601-01-01; the listing
+        # carries no file index, so the inode is left out
+        mtime = entry.ftLastWriteTime
+        mtime = mtime.dwHighDateTime << 32 | mtime.dwLowDateTime
+        return ((mtime - _FILETIME_EPOCH) * 100,
+                entry.nFileSizeHigh << 32 | entry.nFileSizeLow, 0)
+    st = entry.stat(follow_symlinks=False)
+    return st.st_mtime_ns, st.st_size, entry.inode()
+
+
+def _hash_files(paths):
+    """
+    Hash files into the object store using a thread pool
+
+    args:
+        paths (list): The paths of the files to hash
+
+    returns:
+        A dictionary of path -> oid
+    """
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        return dict(zip(paths, executor.map(data.hash_file, paths)))
+
+
 def get_index_tree():
     """
        function to get the index tree
@@ -142,12 +304,8 @@ def get_index_tree():
 
 def _empty_current_directory():
     """ Empty the current directory """
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
+    for path, _ in _walk_files('.'):
+        os.remove(path)
 
 
 def read_tree(tree_oid, update_working=False):
@@ -202,10 +360,21 @@ def _checkout_index(index):
         None
     """
     _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+
+    # Create every directory up front, parents first
+    dirnames = {os.path.dirname(path) for path in index}
+    for dirname in sorted(dirnames, key=lambda dirname: dirname.count('/')):
+        os.makedirs(f'./{dirname}', exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        list(executor.map(_checkout_file, index.items()))
+
+
+def _checkout_file(item):
+    """ Write a single (path, oid) index entry to the working directory """
+    path, oid = item
+    with open(path, 'wb') as f:
+        f.write(data.get_object(oid, 'blob'))
 
 
 def commit(message):
@@ -334,7 +503,7 @@ def get_merge_base(oid1, oid2):
     Returns:
         The oid of the merge base
     """
-    parents1 = list(iter_commits_and_parents({oid1}))
+    parents1 = set(iter_commits_and_parents({oid1}))
 
     for oid in iter_commits_and_parents({oid2}):
         if oid in parents1:
@@ -399,25 +568,36 @@ def get_branch_name():
 
 Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
 
+_HDR_RE = re.compile(rb'([^ \n]+) ([^\n]*)\n?')
 
+
+@functools.lru_cache(maxsize=2048)
 def get_commit(oid):
     """
     get commit by oid 
     """
+    tree = None
     parents = []
 
-    commit = data.get_object(oid, 'commit').decode()
-    lines = iter(commit.splitlines())
-    for line in itertools.takewhile(operator.truth, lines):
-        key, value = line.split(' ', 1)
-        if key == 'tree':
-            tree = value
-        elif key == 'parent':
-            parents = []
+    header, _, message = data.get_object(oid, 'commit').partition(b'\n\n')
+    # Header lines must follow each other back to back
+    end = 0
+    for match in _HDR_RE.finditer(header):
+        assert match.start() == end, f'Corrupt commit {oid}'
+        end = match.end()
+        key, value = match.groups()
+        if key == b'tree':
+            tree = value.decode()
+        elif key == b'parent':
+            parents.append(value.decode())
         else:
-            assert False, f'Unknown field {key}'
+            assert False, f'Unknown field {key.decode()}'
+    assert end == len(header), f'Corrupt commit {oid}'
+    assert tree, f'Commit {oid} has no tree'
 
-    message = '\n'.join(lines)
+    message = message.decode()
+    if message.endswith('\n'):
+        message = message[:-1]
     return Commit(tree=tree, parents=parents, message=message)
 
 
@@ -449,15 +629,20 @@ def iter_objects_in_commits(oids):
     visited = set()
 
     def iter_objects_in_tree(oid):
-        visited.add(oid)
-        yield oid
-        for type_, oid, _ in _iter_tree_entries(oid):
-            if oid not in visited:
-                if type_ == 'tree':
-                    yield from iter_objects_in_tree(oid)
-                else:
-                    visited.add(oid)
-                    yield oid
+        stack = [oid]
+        while stack:
+            oid = stack.pop()
+            if oid in visited:
+                continue
+            visited.add(oid)
+            yield oid
+            for type_, oid, _ in _iter_tree_entries(oid):
+                if oid not in visited:
+                    if type_ == 'tree':
+                        stack.append(oid)
+                    else:
+                        visited.add(oid)
+                        yield oid
 
     for oid in iter_commits_and_parents(oids):
         yield oid
@@ -470,21 +655,23 @@ def get_oid(name):
     if name == '@':
         name = 'HEAD'
 
-    refs_to_try = [
-        f'{name}',
-        f'refs/{name}',
-        f'refs/tags/{name}',
-        f'refs/heads/{name}',
-    ]
+    # Name is SHA1
+    if len(name) == 40 and _HEX.issuperset(name):
+        return name
+
+    if name == 'HEAD':
+        refs_to_try = ['HEAD']
+    else:
+        refs_to_try = [
+            f'{name}',
+            f'refs/{name}',
+            f'refs/tags/{name}',
+            f'refs/heads/{name}',
+        ]
     for ref in refs_to_try:
         if data.get_ref(ref, deref=False).value:
             return data.get_ref(ref).value
 
-    # Name is SHA1
-    is_hex = all(c in string.hexdigits for c in name)
-    if len(name) == 40 and is_hex:
-        return name
-
     assert False, f'Unknown name {name}'
 
 
@@ -495,18 +682,21 @@ def add(filenames):
     def add_file(filename):
         # Normalize path
         filename = os.path.relpath(filename)
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
+        index[filename] = data.hash_file(filename)
 
     def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                # Normalize path
-                path = os.path.relpath(f'{root}/{filename}')
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+        paths = []
+        # Normalize the root once, the walk keeps paths relative to it
+        root = os.path.relpath(dirname).replace(os.sep, '/')
+        for path, _ in _walk_files(root):
+            paths.append(path[2:] if path.startswith('./') else path)
+
+        # Only bulk adds are worth collecting into a pack
+        if len(paths) >= _PACK_MIN_FILES:
+            with data.PackWriter():
+                index.update(_hash_files(paths))
+        else:
+            index.update(_hash_files(paths))
 
     with data.get_index() as index:
         for name in filenames:
@@ -132,8 +132,7 @@ def init (args):
 
 
 def hash_object (args):
-    with open (args.file, 'rb') as f:
-        print (data.hash_object (f.read ()))
+    print (data.hash_file (args.file))
 
 
 def cat_file (args):
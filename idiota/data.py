@@ -17,17 +17,51 @@ __version__ = "1.0.1"
 __email__ = "prakashsellathurai@gmail.com"
 
 import os
+import functools
 import hashlib
+import mmap
+import pickle
 import shutil
+import sys
 import json
+import threading
+import time
 
 from collections import namedtuple
 from contextlib import contextmanager
 
 
 GIT_DIR = None
+# Real path of GIT_DIR, resolved once when it is set and used to key the
+# object caches, so two repositories never share entries
+_GIT_DIR_REAL = None
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
+# Object types as they appear in object headers
+_TYPES = {'blob': b'blob', 'tree': b'tree', 'commit': b'commit', 'tag': b'tag'}
+
+# PackWriters currently collecting objects, innermost last
+_PACK_WRITERS = []
+# Packed objects per git directory real path, see _packed_objects
+_PACKS = {}
+
+# Ref names and raw ref values read so far, see _refs_cache
+_REFS_CACHE = {'git_dir': None, 'mtime': None, 'names': None, 'refs': {}}
+
+# IDIOTA_HASH=blake2b swaps sha1 for a 20 byte blake2b digest, which keeps the
+# 40 hex digit oids but is not compatible with objects written with sha1
+HASH_ALGORITHM = os.environ.get('IDIOTA_HASH', 'sha1')
+assert HASH_ALGORITHM in ('sha1', 'blake2b'), \
+    f'Unknown hash algorithm {HASH_ALGORITHM}'
+
+if HASH_ALGORITHM == 'blake2b':
+    _hasher = functools.partial(hashlib.blake2b, digest_size=20)
+elif sys.version_info >= (3, 9):
+    # oids are not a security boundary, skip the FIPS gating
+    _hasher = functools.partial(hashlib.sha1, usedforsecurity=False)
+else:
+    _hasher = hashlib.sha1
+
 @contextmanager
 def change_git_dir(new_dir) -> None:
     """
@@ -39,11 +73,12 @@ def change_git_dir(new_dir) -> None:
     Yields:
         str: old git directory
     """
-    global GIT_DIR
-    old_dir = GIT_DIR
+    global GIT_DIR, _GIT_DIR_REAL
+    old_dir, old_real = GIT_DIR, _GIT_DIR_REAL
     GIT_DIR = f'{new_dir}/.idiota'
+    _GIT_DIR_REAL = os.path.realpath(GIT_DIR)
     yield
-    GIT_DIR = old_dir
+    GIT_DIR, _GIT_DIR_REAL = old_dir, old_real
 
 
 def init() -> None:
@@ -53,8 +88,14 @@ def init() -> None:
     Returns:
         None
     """
+    global _GIT_DIR_REAL
     os.makedirs(GIT_DIR, exist_ok=True)
     os.makedirs(f'{GIT_DIR}/objects')
+    _GIT_DIR_REAL = os.path.realpath(GIT_DIR)
+
+    # Forget anything cached about a repository that used to live here
+    _PACKS.pop(_GIT_DIR_REAL, None)
+    _read_cached_object.cache_clear()
 
 
 
@@ -88,6 +129,7 @@ def update_ref(ref, value, deref: bool=True) -> None:
     os.makedirs(os.path.dirname(ref_path), exist_ok=True)
     with open(ref_path, 'w') as f:
         f.write(value)
+    _REFS_CACHE['mtime'] = None
 
 
 def get_ref(ref, deref=True) -> RefValue:
@@ -106,29 +148,59 @@ def delete_ref(ref, deref=True)->None:
     """ Delete a ref"""
     ref = _get_ref_internal(ref, deref)[0]
     os.remove(f'{GIT_DIR}/{ref}')
+    _REFS_CACHE['mtime'] = None
+
+
+def _refs_cache() -> dict:
+    """ Get the ref cache for the current git directory
+
+    The cache is dropped whenever the git directory or the mtime of refs/
+    changes. Writes made through update_ref and delete_ref invalidate it
+    explicitly, since rewriting a ref file in place leaves refs/ untouched.
+
+    Returns:
+        dict: cache with the scanned ref names and the raw ref values
+    """
+    try:
+        mtime = os.stat(f'{GIT_DIR}/refs').st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
 
+    if (mtime is None or _REFS_CACHE['mtime'] != mtime
+            or _REFS_CACHE['git_dir'] != GIT_DIR):
+        _REFS_CACHE.update(git_dir=GIT_DIR, mtime=mtime, names=None, refs={})
+    return _REFS_CACHE
 
-def _get_ref_internal(ref, deref) -> RefValue:
+
+def _get_ref_internal(ref, deref, refs=None) -> RefValue:
     """ Get a ref value
     
     Args:
         ref (str): ref name
         deref (bool): dereference symbolic refs
+        refs (dict): raw ref values to read through, defaults to the cache
     
     Returns:
         RefValue (str): ref value
     """
-    ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    if refs is None:
+        refs = _refs_cache()['refs']
+
+    if ref in refs:
+        value = refs[ref]
+    else:
+        ref_path = f'{GIT_DIR}/{ref}'
+        value = None
+        if os.path.isfile(ref_path):
+            with open(ref_path) as f:
+                value = f.read().strip()
+        refs[ref] = value
 
     symbolic = bool(value) and value.startswith('ref:')
     if symbolic:
         value = value.split(':', 1)[1].strip()
         if deref:
-            return _get_ref_internal(value, deref=True)
+            return _get_ref_internal(value, deref=True, refs=refs)
 
     return ref, RefValue(symbolic=symbolic, value=value)
 
@@ -143,15 +215,28 @@ def iter_refs(prefix='', deref=True):
     Returns:
         Iterator[Tup(str, RefValue)]: ref name and ref value
     """
-    refs = ['HEAD', 'MERGE_HEAD']
-    for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{name}' for name in filenames)
-
-    for refname in refs:
+    cache = _refs_cache()
+    if cache['names'] is None:
+        names = ['HEAD', 'MERGE_HEAD']
+        stack = ['refs']
+        while stack:
+            root = stack.pop()
+            try:
+                entries = os.scandir(f'{GIT_DIR}/{root}')
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(f'{root}/{entry.name}')
+                    elif entry.is_file(follow_symlinks=False):
+                        names.append(f'{root}/{entry.name}')
+        cache['names'] = names
+
+    for refname in cache['names']:
         if not refname.startswith(prefix):
             continue
-        ref = get_ref(refname, deref=deref)
+        ref = _get_ref_internal(refname, deref, cache['refs'])[1]
         if ref.value:
             yield refname, ref
 
@@ -163,22 +248,86 @@ def get_index():
     Yields:
         Index: index
     """
-    index = {}
+    index = _DirtyDict()
     if os.path.isfile(f'{GIT_DIR}/index'):
-        with open(f'{GIT_DIR}/index') as f:
-            index = json.load(f)
+        with open(f'{GIT_DIR}/index', 'rb') as f:
+            raw = f.read()
+        # Indexes written before the switch to pickle are JSON
+        if raw.startswith(b'{'):
+            dict.update(index, json.loads(raw))
+        elif raw:
+            dict.update(index, pickle.loads(raw))
 
     yield index
 
-    with open(f'{GIT_DIR}/index', 'w') as f:
-        json.dump(index, f)
+    # Only write an index that was modified, atomically
+    if index.dirty:
+        with open(f'{GIT_DIR}/index.tmp', 'wb') as f:
+            pickle.dump(dict(index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{GIT_DIR}/index.tmp', f'{GIT_DIR}/index')
+
+
+class _DirtyDict(dict):
+    """ A dict that records whether it has been modified """
+
+    dirty = False
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        super().__delitem__(key)
+
+    def clear(self):
+        self.dirty = True
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        self.dirty = True
+        super().update(*args, **kwargs)
+
+    def pop(self, *args):
+        self.dirty = True
+        return super().pop(*args)
+
+    def popitem(self):
+        self.dirty = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.dirty = True
+        return super().setdefault(key, default)
+
+
+def get_stat_cache() -> dict:
+    """ Get the working tree stat cache
+
+    Returns:
+        dict: path -> (oid, mtime_ns, size, inode)
+    """
+    if not os.path.isfile(f'{GIT_DIR}/stat_cache'):
+        return {}
+    with open(f'{GIT_DIR}/stat_cache', 'rb') as f:
+        return pickle.load(f)
+
+
+def set_stat_cache(cache: dict) -> None:
+    """ Write the working tree stat cache
+
+    Args:
+        cache (dict): path -> (oid, mtime_ns, size, inode)
+    """
+    with open(f'{GIT_DIR}/stat_cache', 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def hash_object(data: object, type_='blob')-> str:
     """
     Hash an object
     
-    uses: Sha1 algorithm
+    uses: Sha1 algorithm (or blake2b, see HASH_ALGORITHM)
     
     Args:
         data (bytes): object data
@@ -186,13 +335,63 @@ def hash_object(data: object, type_='blob')-> str:
     Returns:
         str: object id
     """
-    obj = type_.encode() + b'\x00' + data
-    oid = hashlib.sha1(obj).hexdigest()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    prefix = type_.encode() + b'\x00'
+    h = _hasher()
+    h.update(prefix)
+    h.update(data)
+    oid = h.hexdigest()
+
+    # Content addressed, an existing object already holds these bytes
+    if object_exists(oid):
+        return oid
+
+    writer = _active_pack_writer(_GIT_DIR_REAL)
+    if writer is not None:
+        writer.write(oid, prefix, data)
+        return oid
+
+    # Write to a temporary file and rename it into place, so concurrent
+    # writers of the same object never expose a partial file
+    tmp_path = (f'{GIT_DIR}/objects/tmp-{oid}-'
+                f'{os.getpid()}-{threading.get_ident()}')
+    with open(tmp_path, 'wb') as out:
+        if hasattr(os, 'writev'):
+            # One gathered write, finishing off any short write by hand
+            written = os.writev(out.fileno(), [prefix, data])
+            if written < len(prefix):
+                out.write(prefix[written:])
+                written = len(prefix)
+            out.write(memoryview(data)[written - len(prefix):])
+        else:
+            out.write(prefix)
+            out.write(data)
+    os.replace(tmp_path, f'{GIT_DIR}/objects/{oid}')
     return oid
 
 
+def hash_file(path: str, type_='blob') -> str:
+    """
+    Hash a file as an object
+
+    The file is memory mapped so the hasher and the object write read
+    straight from the page cache instead of a Python copy of the contents.
+
+    Args:
+        path (str): file path
+
+    Returns:
+        str: object id
+    """
+    with open(path, 'rb') as f:
+        try:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            return hash_object(f.read(), type_)
+        with view:
+            return hash_object(view, type_)
+
+
 def get_object(oid: str, expected='blob')-> object:
     """
     get an object
@@ -204,18 +403,61 @@ def get_object(oid: str, expected='blob')-> object:
         bytes: object data
     """
 
-    with open(f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
+    git_dir = _GIT_DIR_REAL
+    # Blobs are mostly read once (checkout, diff), so only the trees and
+    # commits that history and tree walks come back to are cached
+    if _TYPES.get(expected, expected) in (b'tree', b'commit', b'tag'):
+        obj = _read_cached_object(git_dir, oid)
+    else:
+        obj = _read_object(git_dir, oid)
 
-    first_null = obj.index(b'\x00')
-    type_ = obj[:first_null].decode()
+    # The header is one of the short _TYPES, so the null is within 8 bytes
+    first_null = obj.find(b'\x00', 0, 8)
+    assert first_null > 0, f'Corrupt object {oid}'
     content = obj[first_null + 1:]
 
     if expected is not None:
-        assert type_ == expected, f'Expected {expected}, got {type_}'
+        type_ = obj[:first_null]
+        assert type_ == _TYPES.get(expected, expected), \
+            f'Expected {expected}, got {type_.decode()}'
     return content
 
 
+def _read_object(git_dir: str, oid: str) -> bytes:
+    """
+    Read a raw object, from a pack or from its loose object file
+
+    git_dir must be a real path, so that two repositories never share
+    cache entries.
+    """
+    writer = _active_pack_writer(git_dir)
+    if writer is not None and oid in writer.offsets:
+        return writer.read(oid)
+
+    packed = _packed_objects(git_dir).get(oid)
+    if packed is None:
+        try:
+            with open(f'{git_dir}/objects/{oid}', 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # The object may be in a pack written since the packs were loaded
+            packed = _packed_objects(git_dir, reload=True).get(oid)
+            if packed is None:
+                raise
+
+    pack_path, offset, length = packed
+    with open(pack_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+# Objects never change once written under their oid, so nothing is ever
+# invalidated
+_read_cached_object = functools.lru_cache(maxsize=4096)(_read_object)
+
+get_object.cache_clear = _read_cached_object.cache_clear
+
+
 def object_exists(oid: bool)-> bool:
     """ 
     checks if object of given id exists in the repository
@@ -226,7 +468,136 @@ def object_exists(oid: bool)-> bool:
     Returns:
         bool: True if object exists
     """
-    return os.path.isfile(f'{GIT_DIR}/objects/{oid}')
+    git_dir = _GIT_DIR_REAL
+    writer = _active_pack_writer(git_dir)
+    if writer is not None and oid in writer.offsets:
+        return True
+    return (oid in _packed_objects(git_dir)
+            or os.path.isfile(f'{git_dir}/objects/{oid}'))
+
+
+class PackWriter:
+    """
+    Append the objects written by hash_object to a single pack file
+
+    Meant for bulk writes: while a PackWriter is active for the current git
+    directory, new objects go into objects/pack/<name>.pack instead of one
+    file each, and their (offset, length) are recorded. The pack is only
+    created once the first object arrives. On exit it is moved into place
+    and its offsets are appended to the combined objects/pack/index.
+    """
+
+    def __init__(self):
+        self.git_dir = _GIT_DIR_REAL
+        self.offsets = {}
+        self._lock = threading.Lock()
+        self._name = f'pack-{os.getpid()}-{time.time_ns()}.pack'
+        self._path = f'{self.git_dir}/objects/pack/{self._name}'
+        self._file = None
+
+    def __enter__(self):
+        _PACK_WRITERS.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _PACK_WRITERS.remove(self)
+        if self._file is None:
+            return
+        self._file.close()
+
+        # The pack goes in place before the index entries that point into it
+        os.replace(f'{self._path}.tmp', self._path)
+        record = {oid: (self._name, offset, length)
+                  for oid, (offset, length) in self.offsets.items()}
+        # One unbuffered append per writer, so concurrent writers cannot
+        # interleave their records
+        with open(f'{self.git_dir}/objects/pack/index', 'ab',
+                  buffering=0) as f:
+            f.write(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+        packs = _PACKS.get(self.git_dir)
+        if packs is not None:
+            for oid, (offset, length) in self.offsets.items():
+                packs[oid] = (self._path, offset, length)
+
+    def write(self, oid, prefix, data) -> None:
+        """ Append an object to the pack
+
+        Args:
+            oid (str): object id
+            prefix (bytes): object header
+            data (bytes): object data
+        """
+        with self._lock:
+            if oid in self.offsets:
+                return
+            if self._file is None:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                self._file = open(f'{self._path}.tmp', 'wb')
+            offset = self._file.tell()
+            self._file.write(prefix)
+            self._file.write(data)
+            self.offsets[oid] = (offset, len(prefix) + len(data))
+
+    def read(self, oid) -> bytes:
+        """ Read back a raw object that was written to this pack
+
+        Args:
+            oid (str): object id
+
+        Returns:
+            bytes: raw object
+        """
+        with self._lock:
+            self._file.flush()
+            offset, length = self.offsets[oid]
+        with open(f'{self._path}.tmp', 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def _active_pack_writer(git_dir):
+    """ Get the innermost active PackWriter for git_dir (a real path) """
+    for writer in reversed(_PACK_WRITERS):
+        if writer.git_dir == git_dir:
+            return writer
+    return None
+
+
+def _packed_objects(git_dir, reload=False) -> dict:
+    """
+    Get the objects stored in the packs of git_dir
+
+    The combined pack index is loaded once per git directory; PackWriter
+    adds its own objects when it finishes.
+
+    Args:
+        git_dir (str): git directory, as a real path
+        reload (bool): read the pack index from disk again
+
+    Returns:
+        dict: oid -> (absolute pack path, offset, length)
+    """
+    packs = _PACKS.get(git_dir)
+    if packs is not None and not reload:
+        return packs
+
+    packs = {}
+    try:
+        with open(f'{git_dir}/objects/pack/index', 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    # End of the index, or a record cut short by a crash
+                    break
+                for oid, (name, offset, length) in record.items():
+                    packs[oid] = (f'{git_dir}/objects/pack/{name}',
+                                  offset, length)
+    except FileNotFoundError:
+        pass
+    _PACKS[git_dir] = packs
+    return packs
 
 
 def fetch_object_if_missing(oid, remote_git_dir):
@@ -242,9 +613,8 @@ def fetch_object_if_missing(oid, remote_git_dir):
     """
     if object_exists(oid):
         return
-    remote_git_dir += '/.ugit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}',
-                f'{GIT_DIR}/objects/{oid}')
+    remote_git_dir += '/.idiota'
+    _transfer_object(oid, remote_git_dir, GIT_DIR)
 
 
 def push_object(oid, remote_git_dir):
@@ -258,6 +628,65 @@ def push_object(oid, remote_git_dir):
     Returns:
         None
     """
-    remote_git_dir += '/.ugit'
-    shutil.copy(f'{GIT_DIR}/objects/{oid}',
-                f'{remote_git_dir}/objects/{oid}')
+    remote_git_dir += '/.idiota'
+    _transfer_object(oid, GIT_DIR, remote_git_dir)
+
+
+def _transfer_object(oid, src_git_dir, dst_git_dir) -> None:
+    """
+    Copy an object between git directories as a loose object
+
+    Args:
+        oid (str): object id
+        src_git_dir (str): git directory holding the object
+        dst_git_dir (str): git directory to copy the object into
+
+    Returns:
+        None
+    """
+    src = f'{src_git_dir}/objects/{oid}'
+    dst = f'{dst_git_dir}/objects/{oid}'
+    if os.path.isfile(src):
+        _copy_object(src, dst)
+    else:
+        # Packed, extract it
+        with open(dst, 'wb') as f:
+            f.write(_read_object(os.path.realpath(src_git_dir), oid))
+
+
+def _copy_object(src, dst) -> None:
+    """
+    Copy an object file without passing its contents through Python
+
+    Uses copy_file_range (which can reflink on filesystems that support it)
+    or sendfile, and falls back to shutil.copyfile where neither is
+    available or the kernel refuses the copy.
+
+    Args:
+        src (str): source path
+        dst (str): destination path
+
+    Returns:
+        None
+    """
+    if hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    if hasattr(os, 'copy_file_range'):
+                        sent = os.copy_file_range(
+                            fsrc.fileno(), fdst.fileno(), size - offset,
+                            offset, offset)
+                    else:
+                        sent = os.sendfile(
+                            fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            if offset == size:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
@@ -11,6 +11,8 @@ __email__ = "prakashsellathurai@gmail.com"
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 from . import base
 from . import data
 
@@ -50,9 +52,10 @@ def push (remote_path, refname):
     local_objects = set (base.iter_objects_in_commits ({local_ref}))
     objects_to_push = local_objects - remote_objects
 
-    # Push missing objects
-    for oid in objects_to_push:
-        data.push_object (oid, remote_path)
+    # Push missing objects, overlapping the copies
+    with ThreadPoolExecutor () as executor:
+        list (executor.map (
+            lambda oid: data.push_object (oid, remote_path), objects_to_push))
 
     # Update server ref to our value
     with data.change_git_dir (remote_path):